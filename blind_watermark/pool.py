@@ -3,7 +3,11 @@ import multiprocessing
 import warnings
 
 if sys.platform != 'win32':
-    multiprocessing.set_start_method('fork')
+    try:
+        multiprocessing.set_start_method('fork')
+    except RuntimeError:
+        # start method already chosen by the caller (e.g. a forkserver/spawn child process)
+        pass
 
 
 class CommonPool(object):
@@ -22,6 +26,7 @@ class AutoPool(object):
         self.processes = processes
 
         if mode == 'vectorization':
+            # WaterMarkCore 直接对所有分块做批量矩阵运算，不经过 pool
             pass
         elif mode == 'cached':
             pass
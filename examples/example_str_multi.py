@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 '''
-demonstrate multiprocessing and multithreading
+demonstrate multiprocessing, multithreading and vectorization
 '''
 # embed string
 from blind_watermark import WaterMark
@@ -50,3 +50,28 @@ wm_extract = bwm1.extract('output/embedded.png', wm_shape=len_wm, mode='str')
 print("不攻击的提取结果：", wm_extract)
 
 assert wm == wm_extract, '提取水印和原水印不一致'
+
+mode = 'vectorization'
+
+bwm = WaterMark(password_img=1, password_wm=1, mode=mode)
+bwm.read_img('pic/ori_img.jpeg')
+wm = '@guofei9987 开源万岁！'
+bwm.read_wm(wm, mode='str')
+bwm.embed('output/embedded.png')
+
+len_wm = len(bwm.wm_bit)  # 解水印需要用到长度
+print('Put down the length of wm_bit {len_wm}'.format(len_wm=len_wm))
+
+# %% 解水印
+bwm1 = WaterMark(password_img=1, password_wm=1, mode=mode)
+wm_extract = bwm1.extract('output/embedded.png', wm_shape=len_wm, mode='str')
+print("不攻击的提取结果：", wm_extract)
+
+assert wm == wm_extract, '提取水印和原水印不一致'
+
+# %% 与逐块计算的结果不逐像素相同，但可以互相提取
+bwm1 = WaterMark(password_img=1, password_wm=1)
+wm_extract = bwm1.extract('output/embedded.png', wm_shape=len_wm, mode='str')
+print("vectorization 嵌入、common 提取的结果：", wm_extract)
+
+assert wm == wm_extract, '提取水印和原水印不一致'
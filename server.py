@@ -1,82 +1,601 @@
+import asyncio
+import functools
+import hashlib
+import io
+import multiprocessing
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import urllib.parse
+import warnings
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List
+
 import cv2
 import numpy as np
-import io
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import StreamingResponse
+from cachetools import LRUCache
+from diskcache import Cache, Timeout
+from fastapi import FastAPI, File, UploadFile, Form, Header, Request, HTTPException
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel
 
 # 导入盲水印核心库
 from blind_watermark.blind_watermark import WaterMark
 
-app = FastAPI(title="Blind Watermark Service")
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    TURBO_JPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # 未安装 PyTurboJPEG 或找不到 libturbojpeg 时，JPEG 也用 OpenCV 解码
+    TURBO_JPEG = None
+
+# ---------------- 配置 ----------------
 
 # 固定长度配置
-MAX_WATERMARK_LENGTH = 256  # 最大支持 256 字符
-FIXED_WM_BIT_LENGTH = 2047  # 固定的 wm_bit 长度（通过 calculate_fixed_length.py 计算得出）
+MAX_WATERMARK_LENGTH = 256  # 最大支持 256 字节（UTF-8）
+FIXED_WM_BIT_LENGTH = 2047  # 固定的 wm_bit 长度：256 字节共 2048 bit，去掉恒为 0 的第一个 bit
+
+# 上传图片按块读取，超过上限立即拒绝，避免把超大文件整个读进内存
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024  # 64 MiB
+MAX_BATCH_SIZE = 64  # /embed_batch 单次最多处理的图片数
+MAX_BATCH_UPLOAD_SIZE = 256 * 1024 * 1024  # /embed_batch 所有图片合计 256 MiB
+
+# 超过该尺寸的图片先等比缩小再嵌入/提取（两端必须使用相同的上限），DWT/DCT/SVD 的耗时与像素数成正比
+MAX_IMAGE_DIM = 2048
+# libjpeg-turbo DCT 缩放后不超过该像素数的解码结果复用工作进程内的缓冲区（最多约 25 MB），
+# 更大的（如只能按 1/4 缩放的超大 JPEG）每次单独分配，避免常驻内存
+DECODE_BUF_MAX_PIXELS = 2 * MAX_IMAGE_DIM * MAX_IMAGE_DIM
+
+# 嵌入结果使用无损格式输出，避免 JPEG 量化破坏刚嵌入的水印
+# WebP 无损比 PNG 小 30~50%，但编码慢一个数量级，大图改用 PNG（压缩级别 1）
+WEBP_MAX_PIXELS = 1024 * 1024
+
+# /extract 结果的磁盘缓存，重启后仍有效，并在多个 uvicorn 工作进程之间共享
+DISK_CACHE_DIR = os.environ.get('BWM_CACHE_DIR', '/var/cache/bwm')
+DISK_CACHE_SIZE_LIMIT = 10 << 30  # 10 GiB
+EXTRACT_CACHE_VERSION = 2  # 提取逻辑改变时递增，使磁盘缓存中的旧结果失效（2：回退到原始分辨率提取）
+
+# uvicorn 工作进程数（通过 `python server.py` 启动时生效），CPU 核数在各工作进程的进程池之间平分
+SERVER_WORKERS = int(os.environ.get('BWM_SERVER_WORKERS', min(4, os.cpu_count() or 1)))
+POOL_WORKERS = max(1, (os.cpu_count() or 1) // SERVER_WORKERS)
+
+# ---------------- 模块级共享状态，导入时只创建一次 ----------------
+
+class _JSONGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that leaves the /embed* endpoints alone.
+
+    Those return WebP/PNG images or zip archives, which are already compressed. Skipped by path because
+    GZipMiddleware only supports excluding content types in recent Starlette releases.
+    """
+    UNCOMPRESSED_PATHS = frozenset(("/embed", "/embed_raw", "/embed_batch"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.UNCOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app = FastAPI(title="Blind Watermark Service")
+# 只压缩 JSON 响应；图片和 zip 本身已压缩，再 gzip 只会浪费 CPU
+app.add_middleware(_JSONGZipMiddleware, minimum_size=512)
+
+# CPU 密集的解码/嵌入/提取放到进程池中执行，避免阻塞事件循环
+# 使用 forkserver：OpenCV 等只在 forkserver 进程中导入一次，工作进程从它 fork 出来
+# 不预加载 blind_watermark，库在导入时初始化的状态不会经 fork 带进工作进程
+if sys.platform != 'win32':
+    _mp_context = multiprocessing.get_context('forkserver')
+    _mp_context.set_forkserver_preload(['numpy', 'cv2', 'pywt'])
+else:
+    _mp_context = multiprocessing.get_context('spawn')
+EXECUTOR = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=_mp_context)
+
+# 结果缓存：以图片内容哈希 + 密码为键，重复请求同一张图片时直接返回
+EXTRACT_CACHE = LRUCache(maxsize=1024)
+EMBED_CACHE = LRUCache(maxsize=256 * 1024 * 1024, getsizeof=lambda result: len(result[0]))  # 按编码后图片的字节数计算容量
+CACHE_LOCK = threading.Lock()
+
+# 工作进程内 libjpeg-turbo 解码输出复用的缓冲区，按需增长到 DECODE_BUF_MAX_PIXELS；每个工作进程串行处理任务，无需加锁
+_decode_buf = np.empty(0, np.uint8)
+
+# 正在计算中的请求（singleflight）：相同的并发请求共享同一个任务，只占用一次进程池
+INFLIGHT = {}
+
+# 每个工作进程按 (password_wm, password_img) 复用 WaterMark 实例，省去重复初始化
+BWM_CACHE = LRUCache(maxsize=64)
+BWM_CACHE_LOCK = threading.Lock()
+
+# 健康检查返回的配置不会变化，只构造一次
+HEALTH_INFO = {
+    "status": "ok",
+    "message": "Blind Watermark service is running.",
+    "config": {
+        "max_watermark_length": MAX_WATERMARK_LENGTH,
+        "fixed_wm_bit_length": FIXED_WM_BIT_LENGTH,
+        "max_image_dim": MAX_IMAGE_DIM
+    }
+}
+
+
+async def _read_upload(file):
+    """Read an upload, rejecting it with 413 as soon as it exceeds MAX_UPLOAD_SIZE.
+
+    When the size is known the body is read straight into one exact-size buffer,
+    otherwise it is read in UPLOAD_CHUNK_SIZE chunks.
+    """
+    readinto = getattr(file.file, 'readinto', None)
+    if file.size is not None and readinto is not None:
+        if file.size > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail=f"Image file exceeds maximum size of {MAX_UPLOAD_SIZE} bytes")
+        # 直接读入预分配的缓冲区，省去中间 bytes 对象和 bytearray 扩容时的拷贝
+        buf = bytearray(file.size)
+        if getattr(file.file, '_rolled', True):
+            # 已落盘的 SpooledTemporaryFile 放到线程池中读，与 UploadFile.read 一致
+            n = await run_in_threadpool(readinto, buf)
+        else:
+            n = readinto(buf)
+        return buf if n == len(buf) else buf[:n]
+
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buf.extend(chunk)
+        if len(buf) > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail=f"Image file exceeds maximum size of {MAX_UPLOAD_SIZE} bytes")
+    return buf
+
+
+def _image_digest(image_bytes):
+    return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+
+def _extract_key(image_bytes, password_img, password_wm):
+    # 用密码（以及影响提取结果的配置）作为 blake2b 的 key，不同密码的结果不会混用，也不会暴露密码
+    key = struct.pack('<qqqqq', password_img, password_wm, FIXED_WM_BIT_LENGTH, MAX_IMAGE_DIM, EXTRACT_CACHE_VERSION)
+    return hashlib.blake2b(image_bytes, digest_size=16, key=key).digest()
+
+
+@functools.lru_cache(maxsize=None)
+def _disk_cache():
+    """Open the shared disk cache on first use. Returns None if DISK_CACHE_DIR isn't usable."""
+    try:
+        return Cache(DISK_CACHE_DIR, size_limit=DISK_CACHE_SIZE_LIMIT)
+    except (OSError, sqlite3.Error, Timeout) as e:
+        # 目录不可写、cache.db 损坏等情况下禁用磁盘缓存（结果被 lru_cache 记住，不会每个请求重试），只用内存 LRU
+        warnings.warn(f"Disk cache disabled, can't open {DISK_CACHE_DIR}: {e}")
+        return None
+
+
+def _disk_get(key):
+    """Look key up in the disk cache. Returns None on a miss or when the disk cache can't be used."""
+    disk_cache = _disk_cache()
+    if disk_cache is None:
+        return None
+    try:
+        return disk_cache.get(key)
+    except (sqlite3.Error, Timeout) as e:
+        # 数据库被锁、损坏等情况当作未命中，照常计算
+        warnings.warn(f"Disk cache read failed: {e}")
+        return None
+
+
+def _disk_set(key, value):
+    disk_cache = _disk_cache()
+    if disk_cache is None:
+        return
+    try:
+        disk_cache.set(key, value)
+    except (sqlite3.Error, Timeout) as e:
+        warnings.warn(f"Disk cache write failed: {e}")
+
+
+def _cache_get(cache, key):
+    with CACHE_LOCK:
+        return cache.get(key)
+
+
+def _cache_set(cache, key, value):
+    with CACHE_LOCK:
+        cache[key] = value
+
+
+def _encode_lossless(img):
+    """Encode as lossless WebP for small images and PNG for large ones. Returns (bytes, media_type)."""
+    if img.shape[0] * img.shape[1] <= WEBP_MAX_PIXELS:
+        # quality > 100 表示 libwebp 无损模式
+        ok, encoded_img = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, 101])
+        if ok:
+            return encoded_img.tobytes(), "image/webp"
+    _, encoded_img = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return encoded_img.tobytes(), "image/png"
+
+
+def get_bwm(password_wm, password_img):
+    """Return the cached WaterMark for this password pair, creating it on first use."""
+    key = (password_wm, password_img)
+    with BWM_CACHE_LOCK:
+        bwm = BWM_CACHE.get(key)
+        if bwm is None:
+            # vectorization 模式一次性批量处理所有分块，避免逐块的 Python 循环
+            bwm = BWM_CACHE[key] = WaterMark(password_wm=password_wm, password_img=password_img, mode='vectorization')
+    return bwm
+
+
+def _reset_bwm(bwm):
+    """Drop the per-request state of a cached WaterMark so it doesn't pin the last image in memory."""
+    bwm.wm_bit, bwm.wm_size = None, 0
+
+    core = bwm.bwm_core
+    core.img, core.img_YUV, core.alpha = None, None, None
+    core.ca, core.hvd = [np.array([])] * 3, [np.array([])] * 3
+    core.ca_block, core.ca_part = [np.array([])] * 3, [np.array([])] * 3
+    core.wm_bit, core.wm_size = None, 0
+    core.block_index, core.idx_shuffle = None, None
+
+
+def _jpeg_orientation(image_bytes):
+    """Return the EXIF orientation of a JPEG, 1 if it has none."""
+    i = 2
+    while i + 4 <= len(image_bytes) and image_bytes[i] == 0xFF:
+        marker = image_bytes[i + 1]
+        if marker == 0xDA:  # SOS 之后是压缩数据，不会再有 EXIF
+            break
+        if marker == 0xE1 and image_bytes[i + 4:i + 10] == b'Exif\0\0':
+            tiff = i + 10
+            endian = 'little' if image_bytes[tiff:tiff + 2] == b'II' else 'big'
+            ifd = tiff + int.from_bytes(image_bytes[tiff + 4:tiff + 8], endian)
+            for k in range(int.from_bytes(image_bytes[ifd:ifd + 2], endian)):
+                entry = ifd + 2 + 12 * k
+                if int.from_bytes(image_bytes[entry:entry + 2], endian) == 0x0112:
+                    return int.from_bytes(image_bytes[entry + 8:entry + 10], endian)
+            return 1
+        i += 2 + int.from_bytes(image_bytes[i + 2:i + 4], 'big')
+    return 1
+
+
+def _decode_dst(height, width):
+    """Return a (height, width, 3) uint8 view of this worker's reusable decode buffer.
+
+    Returns None above DECODE_BUF_MAX_PIXELS, so the decoder allocates a fresh array that is freed afterwards.
+    """
+    global _decode_buf
+    if height * width > DECODE_BUF_MAX_PIXELS:
+        return None
+    size = height * width * 3
+    if _decode_buf.size < size:
+        _decode_buf = np.empty(size, np.uint8)
+    return _decode_buf[:size].reshape(height, width, 3)
+
+
+def _decode_jpeg_turbo(image_bytes):
+    """Decode a JPEG with libjpeg-turbo, letting its DCT scaling do the coarse part of the MAX_IMAGE_DIM downscale.
+
+    Up to DECODE_BUF_MAX_PIXELS the result is a view of the worker's reusable decode buffer and is only
+    valid until the next decode; WaterMark.read_img copies it to float32 right away.
+    Returns None if libjpeg-turbo can't decode it.
+    """
+    try:
+        width, height = TURBO_JPEG.decode_header(image_bytes)[:2]
+        # 选最小的缩放比例，使缩小后的长边仍不小于 MAX_IMAGE_DIM，剩下的交给 INTER_AREA
+        scaling_factor = None
+        for num, denom in sorted(TURBO_JPEG.scaling_factors, key=lambda f: f[0] / f[1]):
+            if num < denom and max(width, height) * num / denom >= MAX_IMAGE_DIM:
+                scaling_factor = (num, denom)
+                width, height = (width * num + denom - 1) // denom, (height * num + denom - 1) // denom
+                break
+        return TURBO_JPEG.decode(image_bytes, pixel_format=TJPF_BGR, scaling_factor=scaling_factor,
+                                 dst=_decode_dst(height, width))
+    except (OSError, ValueError):
+        return None
+
+
+def _decode_image(image_bytes):
+    """Decode to BGR and shrink so the longer side is at most MAX_IMAGE_DIM. Returns None on failure."""
+    # cv2.imdecode 遇到空输入会抛断言错误，而不是返回 None
+    if not image_bytes:
+        return None
+    img = None
+    # libjpeg-turbo 不处理 EXIF 旋转，带旋转信息的 JPEG 仍交给 cv2.imdecode，保证方向一致
+    if TURBO_JPEG is not None and image_bytes[:2] == b'\xff\xd8' and _jpeg_orientation(image_bytes) == 1:
+        img = _decode_jpeg_turbo(image_bytes)
+    if img is None:
+        img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+
+    h, w = img.shape[:2]
+    if max(h, w) > MAX_IMAGE_DIM:
+        scale = MAX_IMAGE_DIM / max(h, w)
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def _wm_payload(wm_content):
+    """Encode wm_content to UTF-8 and pad it with NULs to MAX_WATERMARK_LENGTH bytes.
+
+    The first bit of the payload must be 0 so it can be dropped (see _wm_bits). Content starting with
+    a non-ASCII byte therefore gets a leading NUL, which extraction strips again.
+    """
+    wm_bytes = wm_content.encode('utf-8')
+    if wm_bytes[:1] >= b'\x80':
+        wm_bytes = b'\0' + wm_bytes
+    return wm_bytes.ljust(MAX_WATERMARK_LENGTH, b'\0')
+
+
+@functools.lru_cache(maxsize=4096)
+def _wm_bits(password_wm, wm_payload):
+    """Encrypted FIXED_WM_BIT_LENGTH-bit watermark for a _wm_payload, memoized per worker process.
+
+    For content whose first byte is 0x40-0x7F these are the same bits WaterMark.read_wm(mode='str') produces.
+    """
+    # 去掉第一个 bit（恒为 0），得到固定 FIXED_WM_BIT_LENGTH 个 bit
+    wm_bit = np.unpackbits(np.frombuffer(wm_payload, np.uint8)).astype(bool)[1:]
+    assert wm_bit.size == FIXED_WM_BIT_LENGTH
+    # 水印加密
+    np.random.RandomState(password_wm).shuffle(wm_bit)
+    # 缓存的数组在多次请求间共享，设为只读
+    wm_bit.flags.writeable = False
+    return wm_bit
+
+
+def _do_embed(image_bytes, password_img, password_wm, wm_payload):
+    """Decode, embed and losslessly encode in a worker process. Returns None if the image can't be decoded."""
+    ori_img = _decode_image(image_bytes)
+    if ori_img is None:
+        return None
+
+    bwm = get_bwm(password_wm, password_img)
+    try:
+        bwm.read_img(img=ori_img)
+        # 跳过 read_wm，直接使用缓存的加密后水印 bit
+        bwm.wm_bit = _wm_bits(password_wm, wm_payload)
+        bwm.wm_size = bwm.wm_bit.size
+        bwm.bwm_core.read_wm(bwm.wm_bit)
+        embed_img = bwm.embed()
+    finally:
+        _reset_bwm(bwm)
+
+    return _encode_lossless(embed_img)
+
+
+def _wm_text(wm_bit):
+    """Turn extracted bits back into text. Returns (text, clean).
+
+    clean means the bytes look like a _wm_payload: valid UTF-8 followed only by NUL padding. Bits extracted
+    at the wrong image size are noise and practically never pass.
+    """
+    # bit 转为字节（开头补 0 对齐到整字节），在第一个填充的空字节处截断
+    wm_bit = np.concatenate([np.zeros(-wm_bit.size % 8, dtype=bool), wm_bit])
+    wm_bytes = np.packbits(wm_bit).tobytes().lstrip(b'\0')
+    wm_bytes, _, padding = wm_bytes.partition(b'\0')
+    try:
+        return wm_bytes.decode('utf-8'), not padding.strip(b'\0')
+    except UnicodeDecodeError:
+        return wm_bytes.decode('utf-8', errors='replace'), False
+
+
+def _extract_text(embed_img, password_img, password_wm):
+    bwm = get_bwm(password_wm, password_img)
+    try:
+        # 使用固定的 FIXED_WM_BIT_LENGTH 提取
+        wm_bit = bwm.extract(embed_img=embed_img, wm_shape=FIXED_WM_BIT_LENGTH, mode='bit')
+    finally:
+        _reset_bwm(bwm)
+    return _wm_text(wm_bit)
+
+
+def _do_extract(image_bytes, password_img, password_wm):
+    """Decode and extract in a worker process. Returns None if the image can't be decoded.
+
+    Extraction uses the same MAX_IMAGE_DIM downscale as embedding. If that yields no clean watermark and the
+    image is larger than MAX_IMAGE_DIM, it is retried at native resolution, for images that were embedded
+    without the cap (e.g. by earlier versions of this service).
+    """
+    embed_img = _decode_image(image_bytes)
+    if embed_img is None:
+        return None
+
+    wm_extract, clean = _extract_text(embed_img, password_img, password_wm)
+    if not clean:
+        # 只有解不出有效水印的大图才会多做一次原始分辨率的提取
+        native_img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if native_img is not None and max(native_img.shape[:2]) > MAX_IMAGE_DIM:
+            native_wm, native_clean = _extract_text(native_img, password_img, password_wm)
+            if native_clean:
+                return native_wm
+    return wm_extract
+
+
+async def _run_in_pool(fn, *args):
+    """Run fn(*args) on EXECUTOR.
+
+    If a worker process died (e.g. killed by the OOM killer), the whole pool is broken and every later
+    submit would fail. Replace it with a fresh pool and fail only this request with 503.
+    """
+    global EXECUTOR
+    executor = EXECUTOR
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    except BrokenProcessPool:
+        # 并发请求可能同时遇到同一个损坏的进程池，只替换一次
+        if EXECUTOR is executor:
+            EXECUTOR = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=_mp_context)
+            executor.shutdown(wait=False)
+        raise HTTPException(status_code=503, detail="Worker process crashed, please retry.")
+
+
+async def _singleflight(key, make_coro):
+    """Run make_coro() once per key at a time; concurrent callers with the same key await the same task.
+
+    The task is shielded so one caller disconnecting doesn't cancel it for the others.
+    """
+    task = INFLIGHT.get(key)
+    if task is None:
+        # get 与赋值之间没有 await，单线程事件循环下无需加锁
+        task = INFLIGHT[key] = asyncio.ensure_future(make_coro())
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
+
+
+def _check_wm_content(wm_content):
+    # 按 UTF-8 字节数限制（以非 ASCII 字符开头时多占 1 字节），超出后 bit 长度不再是 FIXED_WM_BIT_LENGTH，无法提取
+    if len(_wm_payload(wm_content)) > MAX_WATERMARK_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Watermark content exceeds maximum length of {MAX_WATERMARK_LENGTH} bytes (UTF-8)"
+        )
+
+
+async def _embed_image(image_bytes, password_img, password_wm, wm_content):
+    """Embed wm_content into an uploaded image via the cache and process pool.
+
+    Returns (encoded_bytes, media_type), or None if the image can't be decoded.
+    """
+    cache_key = (_image_digest(image_bytes), password_img, password_wm, wm_content)
+    result = _cache_get(EMBED_CACHE, cache_key)
+    if result is not None:
+        return result
+
+    async def compute():
+        # 编码为 UTF-8 后填充到固定字节数，提取时不需要 wm_bit_length
+        result = await _run_in_pool(_do_embed, image_bytes, password_img, password_wm, _wm_payload(wm_content))
+        if result is not None:
+            _cache_set(EMBED_CACHE, cache_key, result)
+        return result
+
+    return await _singleflight(cache_key, compute)
+
+
+async def _extract_image(image_bytes, password_img, password_wm):
+    """Extract the watermark from an uploaded image via the cache and process pool.
+
+    Returns the watermark string, or None if the image can't be decoded.
+    """
+    # 先查内存 LRU，再查磁盘缓存，都未命中才提交到进程池；同一图片的并发请求只计算一次
+    cache_key = _extract_key(image_bytes, password_img, password_wm)
+    wm_extract = _cache_get(EXTRACT_CACHE, cache_key)
+    if wm_extract is not None:
+        return wm_extract
+
+    async def compute():
+        # 磁盘缓存是同步的 SQLite 读写，放到线程池中，避免阻塞事件循环
+        wm_extract = await run_in_threadpool(_disk_get, cache_key)
+        if wm_extract is None:
+            wm_extract = await _run_in_pool(_do_extract, image_bytes, password_img, password_wm)
+            if wm_extract is None:
+                return None
+            await run_in_threadpool(_disk_set, cache_key, wm_extract)
+        _cache_set(EXTRACT_CACHE, cache_key, wm_extract)
+        return wm_extract
+
+    return await _singleflight(cache_key, compute)
+
+
+async def _read_body(request):
+    """Read a raw request body, rejecting it with 413 as soon as it exceeds MAX_UPLOAD_SIZE."""
+    content_length = request.headers.get('content-length')
+    if content_length is not None and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"Image file exceeds maximum size of {MAX_UPLOAD_SIZE} bytes")
+
+    buf = bytearray()
+    async for chunk in request.stream():
+        buf.extend(chunk)
+        if len(buf) > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail=f"Image file exceeds maximum size of {MAX_UPLOAD_SIZE} bytes")
+    return buf
+
+
+def _unquote_wm_content(wm_content):
+    # HTTP 头只能是 latin-1，水印内容按 UTF-8 百分号编码后放在 X-Wm-Content 中
+    try:
+        return urllib.parse.unquote(wm_content, errors='strict')
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="X-Wm-Content must be percent-encoded UTF-8")
+
+
+def _embed_response(encoded_img, media_type, wm_content):
+    # 返回图片（不再需要在响应头中返回 wm_bit_length）
+    return Response(
+        content=encoded_img,
+        media_type=media_type,
+        headers={
+            "X-Original-Length": str(len(wm_content)),  # 原始长度（用于调试）
+            "X-Max-Length": str(MAX_WATERMARK_LENGTH)
+        }
+    )
+
 
 @app.get("/", summary="Health Check")
 def read_root():
     """Health check endpoint to confirm the service is running."""
-    return {
-        "status": "ok", 
-        "message": "Blind Watermark service is running.",
-        "config": {
-            "max_watermark_length": MAX_WATERMARK_LENGTH,
-            "fixed_wm_bit_length": FIXED_WM_BIT_LENGTH
-        }
-    }
+    return HEALTH_INFO
 
 @app.post("/embed", summary="Embed Watermark")
 async def embed_watermark(
     password_img: int = Form(..., description="Password for embedding location (integer)"),
     password_wm: int = Form(..., description="Password for watermark encryption (integer)"),
-    wm_content: str = Form(..., description="Watermark text content (max 256 characters)"),
+    wm_content: str = Form(..., description="Watermark text content (max 256 bytes in UTF-8)"),
     file: UploadFile = File(..., description="Original image file")
 ):
     """
     Embeds a text watermark into an image using fixed-length padding.
     Watermark is padded to MAX_WATERMARK_LENGTH, so extraction doesn't need wm_bit_length parameter.
+    Images larger than MAX_IMAGE_DIM on their longer side are downscaled before embedding,
+    so the returned image is smaller than the upload.
     """
     try:
         # 1. 验证水印长度
-        if len(wm_content) > MAX_WATERMARK_LENGTH:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Watermark content exceeds maximum length of {MAX_WATERMARK_LENGTH} characters"
-            )
-        
-        # 2. 填充水印到固定长度
-        wm_content_padded = wm_content.ljust(MAX_WATERMARK_LENGTH, '\0')
-        
-        # 3. 读取上传的图片
-        image_bytes = await file.read()
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        ori_img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if ori_img is None:
+        _check_wm_content(wm_content)
+
+        # 2. 按块读取上传的图片（异步 I/O，留在事件循环中）
+        image_bytes = await _read_upload(file)
+
+        # 3. 填充、解码、嵌入、无损编码，在进程池中执行（相同的请求直接命中缓存）
+        result = await _embed_image(image_bytes, password_img, password_wm, wm_content)
+        if result is None:
             raise HTTPException(status_code=400, detail="Invalid image file.")
+        encoded_img, media_type = result
 
-        # 4. 初始化水印工具
-        bwm = WaterMark(password_wm=password_wm, password_img=password_img)
-        bwm.read_img(img=ori_img)
-        bwm.read_wm(wm_content_padded, mode='str')
-        
-        # 5. 记录实际的 wm_bit_length（用于日志）
-        actual_wm_bit_length = len(bwm.wm_bit)
-        
-        # 6. 执行嵌入
-        embed_img = bwm.embed()
+        # 4. 返回图片
+        return _embed_response(encoded_img, media_type, wm_content)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during embedding: {str(e)}")
 
-        # 7. 将处理后的图片编码为JPEG格式并返回
-        _, encoded_img = cv2.imencode(".jpg", embed_img)
-        
-        # 8. 返回图片（不再需要在响应头中返回 wm_bit_length）
-        return StreamingResponse(
-            io.BytesIO(encoded_img.tobytes()), 
-            media_type="image/jpeg",
-            headers={
-                "X-Original-Length": str(len(wm_content)),  # 原始长度（用于调试）
-                "X-Max-Length": str(MAX_WATERMARK_LENGTH)
-            }
-        )
+
+@app.post("/embed_raw", summary="Embed Watermark (Raw Body)")
+async def embed_watermark_raw(
+    request: Request,
+    password_img: int = Header(..., alias="X-Password-Img", description="Password for embedding location (integer)"),
+    password_wm: int = Header(..., alias="X-Password-Wm", description="Password for watermark encryption (integer)"),
+    wm_content: str = Header(..., alias="X-Wm-Content",
+                             description="Watermark text content, percent-encoded UTF-8 (max 256 bytes)")
+):
+    """
+    Same as /embed, but the original image is sent as the raw request body
+    (e.g. `Content-Type: image/jpeg`) and the parameters in request headers.
+    Skips multipart parsing and the upload spool file, which is cheaper for small images.
+    The parameters are headers rather than query parameters so the passwords don't end up in access logs.
+    """
+    try:
+        wm_content = _unquote_wm_content(wm_content)
+        _check_wm_content(wm_content)
+        image_bytes = await _read_body(request)
+
+        result = await _embed_image(image_bytes, password_img, password_wm, wm_content)
+        if result is None:
+            raise HTTPException(status_code=400, detail="Invalid image file.")
+        encoded_img, media_type = result
+
+        return _embed_response(encoded_img, media_type, wm_content)
 
     except HTTPException:
         raise
@@ -84,7 +603,69 @@ async def embed_watermark(
         raise HTTPException(status_code=500, detail=f"An error occurred during embedding: {str(e)}")
 
 
-@app.post("/extract", summary="Extract Watermark")
+@app.post("/embed_batch", summary="Embed Watermark (Batch)")
+async def embed_watermark_batch(
+    password_img: int = Form(..., description="Password for embedding location (integer)"),
+    password_wm: int = Form(..., description="Password for watermark encryption (integer)"),
+    wm_content: str = Form(..., description="Watermark text content (max 256 bytes in UTF-8)"),
+    files: List[UploadFile] = File(..., description="Original image files")
+):
+    """
+    Embeds the same text watermark into several images in one request.
+    Images are processed concurrently on the process pool and returned as a zip archive,
+    in upload order, named `<index>_<original name>.<webp|png>`.
+    """
+    try:
+        # 1. 验证水印长度和图片数量
+        _check_wm_content(wm_content)
+        if len(files) > MAX_BATCH_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SIZE} images per batch")
+
+        # 2. 依次读取上传的图片，合计超过 MAX_BATCH_UPLOAD_SIZE 立即拒绝，不再读入后面的图片
+        bodies = []
+        total_size = 0
+        for f in files:
+            if f.size is not None and total_size + f.size > MAX_BATCH_UPLOAD_SIZE:
+                raise HTTPException(
+                    status_code=413, detail=f"Batch exceeds maximum total size of {MAX_BATCH_UPLOAD_SIZE} bytes")
+            body = await _read_upload(f)
+            total_size += len(body)
+            if total_size > MAX_BATCH_UPLOAD_SIZE:
+                raise HTTPException(
+                    status_code=413, detail=f"Batch exceeds maximum total size of {MAX_BATCH_UPLOAD_SIZE} bytes")
+            bodies.append(body)
+
+        # 3. 所有图片同时提交到进程池
+        results = await asyncio.gather(
+            *(_embed_image(b, password_img, password_wm, wm_content) for b in bodies))
+
+        # 4. 打包为 zip 返回；图片已是压缩格式，不再重复压缩
+        zip_buf = io.BytesIO()
+        with zipfile.ZipFile(zip_buf, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for i, (f, result) in enumerate(zip(files, results)):
+                if result is None:
+                    raise HTTPException(status_code=400, detail=f"Invalid image file: {f.filename}")
+                encoded_img, media_type = result
+                stem = os.path.splitext(os.path.basename(f.filename or 'image'))[0]
+                zf.writestr(f"{i:04d}_{stem}.{media_type.split('/')[1]}", encoded_img)
+
+        return Response(
+            content=zip_buf.getvalue(),
+            media_type="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="embedded.zip"'}
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during batch embedding: {str(e)}")
+
+
+class ExtractResult(BaseModel):
+    watermark: str
+
+
+@app.post("/extract", summary="Extract Watermark", response_model=ExtractResult)
 async def extract_watermark(
     password_img: int = Form(..., description="Password for embedding location (integer)"),
     password_wm: int = Form(..., description="Password for watermark encryption (integer)"),
@@ -93,25 +674,61 @@ async def extract_watermark(
     """
     Extracts a text watermark from an image using fixed-length extraction.
     No need to provide wm_bit_length - it uses the fixed FIXED_WM_BIT_LENGTH.
+    Images larger than MAX_IMAGE_DIM are downscaled first, the same way /embed does; if no valid
+    watermark is found that way, extraction is retried at the image's native resolution.
     """
     try:
-        # 1. 读取上传的图片
-        image_bytes = await file.read()
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        embed_img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if embed_img is None:
+        # 1. 按块读取上传的图片
+        image_bytes = await _read_upload(file)
+
+        # 2. 解码并提取（使用固定的 FIXED_WM_BIT_LENGTH），在进程池中执行（相同的请求直接命中缓存）
+        wm_extract = await _extract_image(image_bytes, password_img, password_wm)
+        if wm_extract is None:
             raise HTTPException(status_code=400, detail="Invalid image file.")
 
-        # 2. 初始化水印工具
-        bwm = WaterMark(password_wm=password_wm, password_img=password_img)
-        
-        # 3. 执行提取（使用固定的 FIXED_WM_BIT_LENGTH）
-        wm_extract = bwm.extract(embed_img=embed_img, wm_shape=FIXED_WM_BIT_LENGTH, mode='str')
-        
-        # 4. 去除填充的空字符
-        wm_extract = wm_extract.rstrip('\0')
-        
         return {"watermark": wm_extract}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred during extraction: {str(e)}")
+
+
+@app.post("/extract_raw", summary="Extract Watermark (Raw Body)", response_model=ExtractResult)
+async def extract_watermark_raw(
+    request: Request,
+    password_img: int = Header(..., alias="X-Password-Img", description="Password for embedding location (integer)"),
+    password_wm: int = Header(..., alias="X-Password-Wm", description="Password for watermark encryption (integer)")
+):
+    """
+    Same as /extract, but the watermarked image is sent as the raw request body
+    and the passwords in the `X-Password-Img` / `X-Password-Wm` headers.
+    """
+    try:
+        image_bytes = await _read_body(request)
+
+        wm_extract = await _extract_image(image_bytes, password_img, password_wm)
+        if wm_extract is None:
+            raise HTTPException(status_code=400, detail="Invalid image file.")
+
+        return {"watermark": wm_extract}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during extraction: {str(e)}")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=SERVER_WORKERS,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=256,
+        timeout_keep_alive=30,  # 批量客户端复用连接，省去每张图片的 TCP/TLS 握手
+    )